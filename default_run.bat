@@ -4,4 +4,6 @@ start /b \
     -d <PATH_TO_BACKUP_DESTINATION> \
     -i (OPTIONAL) <IGNORE_REGEX_PATH> \
     -o (OPTIONAL) <PATH_TO_LOGs_DIR> \
-    -l (OPTIONAL) <LOG_LEVEL>
\ No newline at end of file
+    -l (OPTIONAL) <LOG_LEVEL> \
+    -x (OPTIONAL) \
+    -H (OPTIONAL)
\ No newline at end of file
@@ -0,0 +1,206 @@
+import errno
+import os
+import shutil
+import stat
+from typing import Optional, Union
+
+PathLike = Union[str, os.PathLike]
+
+# Errors which mean a given copy mechanism can never work on this OS, whatever the files, so
+#   it's switched off for good rather than failing once for every single copy. Any other
+#   error before anything's been copied just moves on to the next mechanism for this file
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.ENOTSOCK}
+
+# Which in-kernel copy mechanisms to try, see `_UNSUPPORTED_ERRNOS`
+_use_copy_file_range = hasattr(os, "copy_file_range")
+_use_sendfile = hasattr(os, "sendfile")
+
+# How much the read/write fallback moves per syscall; 1 MiB rather than shutil's 64 KiB
+#   default outside of Windows, to cut down on syscalls for larger files
+_COPY_BUFSIZE = 1024 * 1024
+
+# Windows needs files opened as binary or it'll translate line endings on read/write
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    # Lets Windows copy the file itself, which it can do without the bytes passing through
+    #   us, and which also carries over the modification time and file attributes
+    _CopyFileW = ctypes.WinDLL("kernel32", use_last_error=True).CopyFileW
+    _CopyFileW.argtypes = (wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.BOOL)
+    _CopyFileW.restype = wintypes.BOOL
+    _ERROR_ACCESS_DENIED = 5
+else:
+    _CopyFileW = None
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, size: int, blocksize: int) -> bool:
+    """
+    Copies from src_fd to dst_fd entirely within the kernel using copy_file_range
+    Arguments:
+        src_fd (int): The file descriptor to read from, at its current position
+        dst_fd (int): The file descriptor to write to, at its current position
+        size (int): How big src_fd's file is expected to be, going by its last stat
+        blocksize (int): The most bytes to ask the kernel to copy per call
+    Returns:
+        (bool): True if the file was copied, False if copy_file_range can't be used here
+    """
+    global _use_copy_file_range
+
+    copied = 0
+    while True:
+        try:
+            sent = os.copy_file_range(src_fd, dst_fd, blocksize)
+        except OSError as exc:
+            # Like shutil, fall back on anything short of running out of space so long as
+            #   nothing's been written yet, as the destination was truncated on open
+            if copied == 0 and exc.errno != errno.ENOSPC:
+                if exc.errno in _UNSUPPORTED_ERRNOS:
+                    _use_copy_file_range = False
+                return False
+            raise
+        if sent == 0:
+            # Some filesystems (procfs, FUSE, ...) report nothing to copy rather than an error
+            return copied > 0 or size == 0
+        copied += sent
+
+
+def _sendfile(src_fd: int, dst_fd: int, size: int, blocksize: int) -> bool:
+    """
+    Copies from src_fd to dst_fd without the bytes passing through userspace using sendfile
+    Arguments:
+        src_fd (int): The file descriptor to read from, at its current position
+        dst_fd (int): The file descriptor to write to, at its current position
+        size (int): How big src_fd's file is expected to be, going by its last stat
+        blocksize (int): The most bytes to ask the kernel to copy per call
+    Returns:
+        (bool): True if the file was copied, False if sendfile can't be used here
+    """
+    global _use_sendfile
+
+    # Only Linux takes None to mean "from the current position", so track the offset ourselves
+    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+    copied = 0
+    while True:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset + copied, blocksize)
+        except OSError as exc:
+            if copied == 0 and exc.errno != errno.ENOSPC:
+                # Only Linux can sendfile to a regular file, macOS and the BSDs need a socket
+                if exc.errno in _UNSUPPORTED_ERRNOS:
+                    _use_sendfile = False
+                return False
+            raise
+        if sent == 0:
+            # Same as copy_file_range, an empty first read on a non-empty file isn't the end
+            return copied > 0 or size == 0
+        copied += sent
+
+
+def _read_write(src_fd: int, dst_fd: int) -> None:
+    """
+    Copies from src_fd to dst_fd with a plain read/write loop, used when no faster way exists
+    Arguments:
+        src_fd (int): The file descriptor to read from, at its current position
+        dst_fd (int): The file descriptor to write to, at its current position
+    """
+    while True:
+        buf = os.read(src_fd, _COPY_BUFSIZE)
+        if not buf:
+            return
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(dst_fd, view) :]
+
+
+def _open_dst(dst: PathLike) -> int:
+    """
+    Opens dst for writing, creating it or truncating whatever is already there
+    Arguments:
+        dst (str | os.PathLike): The path to open
+    Returns:
+        (int): The file descriptor of the opened file
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY
+    try:
+        return os.open(dst, flags, 0o644)
+    except PermissionError:
+        # The backup of a read-only file is read-only too, but it can still be replaced. If
+        #   there's no backup yet it's the directory that's read-only, which isn't ours to fix
+        if not os.path.lexists(dst):
+            raise
+        os.unlink(dst)
+        return os.open(dst, flags, 0o644)
+
+
+def fast_copy(
+    src: PathLike,
+    dst: PathLike,
+    src_stat: Optional[os.stat_result] = None,
+    preserve_xattr: bool = False,
+) -> bool:
+    """
+    Copies the contents, permissions and timestamps of src over dst, truncating dst in place
+        rather than deleting it first. The copy is skipped when dst already has the same size
+        and modification time as src, as is the case after a previous copy
+    Arguments:
+        src (str | os.PathLike): The path of the file to copy
+        dst (str | os.PathLike): The path to copy the file to. Its parent directory must exist
+        src_stat (os.stat_result): The result of `os.stat(src)`, if the caller already has it
+        preserve_xattr (bool): Whether to also copy extended attributes and flags, like
+            `shutil.copy2` does, at the cost of several more syscalls per copy
+    Returns:
+        (bool): True if the file was copied, False if dst was already up to date
+    """
+    if src_stat is None:
+        src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        if (
+            dst_stat.st_size == src_stat.st_size
+            and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+        ):
+            return False
+
+    if _CopyFileW is not None:
+        if not _CopyFileW(os.fspath(src), os.fspath(dst), False):
+            error = ctypes.WinError(ctypes.get_last_error())
+            # A backup of a read-only file is read-only too, so let Windows overwrite it. Other
+            #   errors, like a sharing violation on a locked source, aren't fixed by that
+            if error.winerror != _ERROR_ACCESS_DENIED or not os.path.exists(dst):
+                raise error
+            os.chmod(dst, stat.S_IWRITE)
+            if not _CopyFileW(os.fspath(src), os.fspath(dst), False):
+                raise ctypes.WinError(ctypes.get_last_error())
+        return True
+
+    # Ask for the whole file in one go where the kernel does the copying
+    blocksize = min(max(src_stat.st_size, 1 << 23), 1 << 30)
+
+    src_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+    try:
+        dst_fd = _open_dst(dst)
+        try:
+            copied = False
+            if _use_copy_file_range:
+                copied = _copy_file_range(src_fd, dst_fd, src_stat.st_size, blocksize)
+            if not copied and _use_sendfile:
+                copied = _sendfile(src_fd, dst_fd, src_stat.st_size, blocksize)
+            if not copied:
+                _read_write(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    if preserve_xattr:
+        shutil.copystat(src, dst)
+    else:
+        os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+    return True
@@ -0,0 +1,88 @@
+import re
+from typing import List, Optional, Union
+
+try:
+    import hyperscan
+except ImportError:  # Optional -- we fall back to Python's own `re` without it
+    hyperscan = None
+
+
+class HyperscanPattern:
+    """
+    Stands in for a compiled `re.Pattern` with a Hyperscan database, which matches in a single
+        pass over the path rather than backtracking. Only `search` is supported, and like the
+        Hyperscan database it wraps, it must only be used from one thread at a time
+    """
+
+    def __init__(self, pattern: str):
+        """
+        Arguments:
+            pattern (str): The regex to match. Raises `hyperscan.error` if Hyperscan can't
+                compile it, e.g. if it uses back-references or lookarounds
+        """
+        self._db = hyperscan.Database()
+        # UTF8 and UCP make `.`, `\w`, `[^/]` etc. match whole characters, the same as `re`
+        self._db.compile(
+            expressions=[pattern.encode()],
+            flags=[
+                hyperscan.HS_FLAG_SINGLEMATCH
+                | hyperscan.HS_FLAG_UTF8
+                | hyperscan.HS_FLAG_UCP
+            ],
+        )
+        # Paths which aren't valid UTF-8 (undecodable bytes surface as surrogates) can't be
+        #   scanned in UTF-8 mode, so those are left to `re`
+        self._fallback = re.compile(pattern)
+
+    @staticmethod
+    def __on_match(
+        pattern_id: int, start: int, end: int, flags: int, matches: List[int]
+    ) -> None:
+        matches.append(pattern_id)
+
+    def search(self, string: str) -> bool:
+        """
+        Arguments:
+            string (str): The path to search
+        Returns:
+            (bool): Whether the pattern matches anywhere in the string
+        """
+        try:
+            encoded = string.encode("utf-8")
+        except UnicodeEncodeError:
+            return self._fallback.search(string) is not None
+
+        matches: List[int] = []
+        self._db.scan(
+            encoded,
+            match_event_handler=self.__on_match,
+            context=matches,
+        )
+        return bool(matches)
+
+
+def compile_ignore_pattern(
+    pattern: str,
+    use_hyperscan: bool = False,
+) -> Optional[Union[HyperscanPattern, "re.Pattern[str]"]]:
+    """
+    Compiles the ignore pattern with `re`, or with Hyperscan when asked to, it's installed
+        and it supports the pattern
+    Arguments:
+        pattern (str): A regex pattern used to ignore backing up certain paths
+        use_hyperscan (bool): Whether to try Hyperscan first. It reads the pattern as PCRE,
+            which differs from Python's syntax in places, e.g. `a{,3}` or `[[:alpha:]]`, so
+            it's only used when the caller opts into those semantics
+    Returns:
+        (HyperscanPattern | re.Pattern): The compiled pattern, or None if there's no pattern
+    """
+    if not pattern:
+        return None
+
+    if use_hyperscan and hyperscan is not None:
+        try:
+            return HyperscanPattern(pattern)
+        except (hyperscan.error, UnicodeEncodeError):
+            pass  # Uses syntax Hyperscan doesn't support, `re` can still handle it
+
+    return re.compile(pattern)
@@ -1,12 +1,15 @@
 import argparse
 import logging
+import logging.handlers
 from pathlib import Path
 from datetime import datetime
 from datetime import date
 
 import os
+import queue
+import signal
 import sys
-import time
+import threading
 from src.watcher import Watcher
 from enum import Enum
 
@@ -29,9 +32,20 @@ def __init_dirs(logs: str, dest: str):
         os.mkdir(logs)
 
 
-def __get_log_version(today: date) -> int:
-    existing = list(filter(lambda x: x.startswith(str(today)), os.listdir("./logs")))
-    return len(existing) + 1
+def __get_log_version(logs: Path, today: date) -> int:
+    # Go one past the highest version rather than counting files, so that a deleted log
+    #   can't make us reuse (and append to) a later one's name
+    prefix = f"{today}-"
+    latest = 0
+    with os.scandir(logs) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith(prefix) and name.endswith(".log"):
+                try:
+                    latest = max(latest, int(name[len(prefix) : -len(".log")]))
+                except ValueError:
+                    pass  # Not one of ours
+    return latest + 1
 
 
 def main(
@@ -40,6 +54,8 @@ def main(
     ignore_pattern: str,
     log_level: LogLevel,
     log_output: Path,
+    preserve_xattr: bool = False,
+    use_hyperscan: bool = False,
 ) -> None:
     """
     Main method for this entire program
@@ -49,6 +65,8 @@ def main(
         ignore_pattern (str): A regex pattern used to ignore backing up certain directories
         log_level (LogLevel): The verbosity at which logs should be written. Defaults to ERROR from argparse
         log_output (pathlib.Path): The path to a folder where log outputs should be written
+        preserve_xattr (bool): Whether to also back up extended attributes and file flags
+        use_hyperscan (bool): Whether to match ignore_pattern with Hyperscan, if installed
     """
     __init_dirs(log_output, destination)
 
@@ -57,30 +75,60 @@ def main(
     logger = logging.getLogger(__name__)
     logger.setLevel(str(log_level))
 
-    filename = f"{now.date()}-{__get_log_version(now.date())}.log"
+    filename = f"{now.date()}-{__get_log_version(log_output, now.date())}.log"
     filename = log_output.joinpath(filename).resolve().absolute()
 
-    logging.basicConfig(filename=filename)
+    # Records are only queued up by the threads that log them, and written to the file
+    #   on the listener's own thread so that disk I/O never holds up handling events
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.SimpleQueue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, respect_handler_level=True
+    )
+    listener.start()
 
     logger.info(f"Watching directory {source}")
     logger.info(f"Backing up to {destination}")
 
+    from watchdog.observers import Observer
+
+    # A single Observer is shared by every Watcher so they all run on one thread
+    #   and one OS watch instance, rather than each spinning up their own
+    observer = Observer()
+    observer.daemon = True
+
     watcher = Watcher(
         logger,
         source.resolve().absolute(),
         destination.resolve().absolute(),
         ignore_pattern,
+        observer=observer,
+        preserve_xattr=preserve_xattr,
+        use_hyperscan=use_hyperscan,
     )
 
+    # Sleep until a signal asks us to quit instead of waking up periodically to check
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_requested.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_requested.set())
+
     watcher.start()
+    observer.start()
 
-    while True:
-        try:
-            time.sleep(0.001)
-        except KeyboardInterrupt:
-            print("Quitting...")
-            watcher.stop()
-            break
+    if os.name == "nt":
+        # Windows only runs the Ctrl+C handler between waits, so an untimed wait never returns
+        while not stop_requested.wait(1):
+            pass
+    else:
+        stop_requested.wait()
+
+    print("Quitting...")
+    watcher.stop()
+    observer.stop()
+    observer.join()
+    listener.stop()
 
 
 if __name__ == "__main__":
@@ -118,6 +166,20 @@ if __name__ == "__main__":
         default=Path("./logs").resolve().absolute(),
     )
 
+    parser.add_argument(
+        "-x",
+        "--preserve-xattr",
+        help="Also back up extended attributes and file flags, not just permissions and timestamps.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-H",
+        "--hyperscan",
+        help="Match the ignore pattern with Hyperscan if it's installed. Faster, but the pattern is read as PCRE rather than a Python regex.",
+        action="store_true",
+    )
+
     try:
         args = parser.parse_args()
     except Exception as e:
@@ -142,4 +204,12 @@ if __name__ == "__main__":
             f"Argument log_output resolves to {log_output.resolve().absolute()}, which is not a directory."
         )
     else:
-        main(source, destination, args.ignore_pattern, args.log_level, log_output)
+        main(
+            source,
+            destination,
+            args.ignore_pattern,
+            args.log_level,
+            log_output,
+            args.preserve_xattr,
+            args.hyperscan,
+        )
@@ -1,9 +1,16 @@
 import os
-import shutil
-from logging import Logger
+import queue
+from concurrent import futures
+from collections import OrderedDict
+import threading
+from logging import DEBUG, Logger
 from pathlib import Path
 
 from watchdog.events import (
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    EVENT_TYPE_MOVED,
     FileCreatedEvent,
     FileDeletedEvent,
     FileModifiedEvent,
@@ -11,23 +18,85 @@ from watchdog.events import (
     FileSystemEventHandler,
     FileSystemMovedEvent,
 )
-from watchdog.observers import Observer
-import re
+from src.fastcopy import fast_copy
+from src.ignore import compile_ignore_pattern
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+
+# Importing watchdog.observers loads the platform's native watch bindings, which only
+#   need to happen once an Observer is actually made
+if TYPE_CHECKING:
+    from watchdog.observers.api import BaseObserver, ObservedWatch
+
+# The most queued events the worker will pull off in one go to collapse together
+MAX_BATCH_SIZE = 256
+# How long the queue has to stay quiet before the worker stops waiting for more of a burst
+DEBOUNCE_SECONDS = 0.2
+# The most source files whose last copied size & mtime are remembered to skip repeat copies
+MAX_CACHED_SIGNATURES = 10_000
+# The most destination directories remembered as existing to skip repeat os.makedirs calls
+MAX_CACHED_DIRS = 10_000
+# How many files can be copied to the destination at once
+COPY_WORKERS = min(8, os.cpu_count() or 1)
+
+QueuedEvent = Tuple[str, str, str]
 
 
 class Watcher:
+    __slots__ = (
+        "logger",
+        "source",
+        "dest",
+        "_owns_observer",
+        "observer",
+        "handler",
+        "watch",
+    )
+
     def __init__(
-        self, logger: Logger, source: Path, destination: Path, ignore_pattern: str = ""
+        self,
+        logger: Logger,
+        source: Path,
+        destination: Path,
+        ignore_pattern: str = "",
+        observer: Optional["BaseObserver"] = None,
+        preserve_xattr: bool = False,
+        use_hyperscan: bool = False,
     ):
+        """
+        Arguments:
+            logger (logging.Logger): The logger to write events and errors to
+            source (pathlib.Path): The path to watch
+            destination (pathlib.Path): The path to copy directory changes to
+            ignore_pattern (str): A regex pattern used to ignore backing up certain directories
+            observer (watchdog.observers.api.BaseObserver): An optional Observer shared between
+                Watchers, so that they all schedule onto one thread and OS watch instance. When
+                given, the caller is responsible for starting and stopping it
+            preserve_xattr (bool): Whether to also back up extended attributes and file flags
+            use_hyperscan (bool): Whether to match ignore_pattern with Hyperscan, using PCRE
+                rather than Python regex semantics, when it's installed
+        """
         self.logger = logger
         self.source = source.absolute()
         self.dest = destination.absolute()
-        self.observer = Observer()
-        self.observer.daemon = True
-        self.handler = Handler(self.logger, self.source, self.dest, ignore_pattern)
+        self._owns_observer = observer is None
+        if self._owns_observer:
+            from watchdog.observers import Observer
+
+            observer = Observer()
+            observer.daemon = True
+        self.observer = observer
+        self.handler = Handler(
+            self.logger,
+            self.source,
+            self.dest,
+            ignore_pattern,
+            preserve_xattr,
+            use_hyperscan,
+        )
+        self.watch: Optional["ObservedWatch"] = None
 
     def start(self):
-        self.observer.schedule(
+        self.watch = self.observer.schedule(
             self.handler,
             self.source,
             recursive=True,
@@ -39,23 +108,82 @@ class Watcher:
             ],
         )
 
-        self.observer.start()
+        if self._owns_observer:
+            self.observer.start()
         self.logger.info(f"The Observer for {self.source} has been started!")
 
     def stop(self):
-        self.observer.stop()
-        self.observer.join()
+        if self._owns_observer:
+            self.observer.stop()
+            self.observer.join()
+        elif self.watch is not None:
+            self.observer.unschedule(self.watch)
+            self.watch = None
+        self.handler.stop()
         self.logger.info(f"The Observer for {self.source} has been stopped!")
 
 
 class Handler(FileSystemEventHandler):
+    __slots__ = (
+        "logger",
+        "source",
+        "dest",
+        "_ignore_re",
+        "_preserve_xattr",
+        "_src_str",
+        "_dst_str",
+        "_src_len",
+        "_signatures",
+        "_known_dirs",
+        "_dirs_to_clean",
+        "_cache_lock",
+        "_pool",
+        "_queue",
+        "_worker",
+    )
+
     def __init__(
-        self, logger: Logger, source: Path, destination: Path, ignore_pattern: str
+        self,
+        logger: Logger,
+        source: Path,
+        destination: Path,
+        ignore_pattern: str,
+        preserve_xattr: bool = False,
+        use_hyperscan: bool = False,
     ):
         self.logger = logger
         self.source = source
         self.dest = destination
-        self.ignore_pattern = ignore_pattern
+        self._ignore_re = compile_ignore_pattern(ignore_pattern, use_hyperscan)
+        self._preserve_xattr = preserve_xattr
+        # Cached string forms of the roots so that mapping a path to the destination
+        #   doesn't need to rebuild them for every single event
+        self._src_str = str(source.absolute())
+        self._dst_str = str(destination.absolute())
+        self._src_len = len(self._src_str)
+        # (size, mtime) of each source file as of its last copy, least recently used first
+        self._signatures: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        # Destination directories known to exist, least recently used first
+        self._known_dirs: "OrderedDict[str, None]" = OrderedDict()
+        # Destination directories that files were removed from during the current batch,
+        #   which are cleaned up together once the batch has been applied
+        self._dirs_to_clean: Set[str] = set()
+        # Copies run in parallel on the pool, and share the caches above
+        self._cache_lock = threading.Lock()
+        self._pool = futures.ThreadPoolExecutor(COPY_WORKERS)
+        # Events are only queued up on the Observer's thread; all disk work happens on this
+        #   worker so that bursts of events don't hold up the Observer
+        self._queue = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self.__drain, daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        """
+        Applies any events still sitting in the queue, then stops the worker thread
+        """
+        self._queue.put(None)
+        self._worker.join()
+        self._pool.shutdown()
 
     def __log_event(self, event: FileSystemEvent) -> None:
         """
@@ -63,156 +191,356 @@ class Handler(FileSystemEventHandler):
         Arguments:
             event (watchdog.events.FileSystemEvent): the event fired
         """
-        dest_str = f", dest: {event.dest_path}" if event.dest_path else ""
-        self.logger.debug(f"type: {event.event_type}, src: {event.src_path}{dest_str}")
-
-    def __in_destination(self, path: Path) -> Path:
+        # Skip building the message at all unless it's going to be written somewhere
+        if not self.logger.isEnabledFor(DEBUG):
+            return
+
+        if event.dest_path:
+            self.logger.debug(
+                "type: %s, src: %s, dest: %s",
+                event.event_type,
+                event.src_path,
+                event.dest_path,
+            )
+        else:
+            self.logger.debug("type: %s, src: %s", event.event_type, event.src_path)
+
+    def __in_destination(self, path: str) -> str:
         """
         Given a path in the watch directory, converts it to the destination's path instead
         Arguments:
-            path (pathlib.Path): The path in the original directory
+            path (str): The absolute path in the original directory, as given by watchdog
         Returns:
-            (pathlib.Path): The path, but in the destination directory, as absolute
+            (str): The path, but in the destination directory, as absolute
         """
-        # Kind of nasty, but convert to string, find & replace source with destination
-        as_str = str(path).replace(str(self.source), str(self.dest))
-        return Path(as_str).absolute()
+        # The source is always the leading prefix, so swap it out by slicing rather than
+        #   searching the whole string (which would also hit any repeats of it deeper down)
+        if not path.startswith(self._src_str):
+            raise ValueError(f"{path} is not inside of {self._src_str}")
+        return self._dst_str + path[self._src_len :]
 
-    def __recursively_clean_dirs_upwards(self, path: Path) -> None:
+    def __clean_dirs_upwards(self, path: str) -> None:
         """
         Removes empty directories at and above the current one. Stops when it reaches a
-            non-empty directory or recursive path reaches the topmost-path in the destination
+            non-empty directory or the path reaches the topmost-path in the destination
         Arguments:
-            path (pathlib.Path): The path (a directory) at which to start the recursive cleanup
+            path (str): The path (a directory) at which to start the cleanup
         """
-        try:
-            # Base case: we've gone all the way back up to the root, and we'll never delete that..
-            if path == self.dest:
-                return
-            # Ok, the path we're at has items -- no need to keep going up
-            if [x for x in path.iterdir()]:
+        # We've gone all the way back up to the root once we're no longer below it, and we'll
+        #   never delete that..
+        while len(path) > len(self._dst_str) and path.startswith(self._dst_str):
+            try:
+                # Fails without touching anything if the directory still has items in it
+                os.rmdir(path)
+            except OSError:
+                return  # Either it isn't empty, or it's missing now -- no need to keep going up
+            self._known_dirs.pop(path, None)
+            path = os.path.dirname(path)
+
+    def __drain(self) -> None:
+        """
+        Runs on the worker thread: waits for events to be queued, keeps gathering them until
+            no more arrive for `DEBOUNCE_SECONDS`, collapses the events in each batch, then
+            applies them to the destination in the order they happened. Returns once it
+            reaches the `None` put on the queue by `stop`
+        """
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=DEBOUNCE_SECONDS))
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+
+            self.__apply(self.__coalesce(batch))
+
+            # Deepest first, so that parents emptied out by their children go too
+            for path in sorted(self._dirs_to_clean, key=len, reverse=True):
+                self.__clean_dirs_upwards(path)
+            self._dirs_to_clean.clear()
+
+            if stopping:
                 return
-            # Otherwise, we have an empty directory that we should delete
-            shutil.rmtree(path.absolute())
-            # Go up a directory and repeat!
-            up = path.joinpath("..").resolve().absolute()
-            self.__recursively_clean_dirs_upwards(up)
-        except FileNotFoundError:
-            return  # Nothing we can do if the file is missing now
 
-    def on_created(self, event: FileCreatedEvent) -> None:
+    def __apply(self, events: List[QueuedEvent]) -> None:
         """
-        Called upon creation of a new file. Upon creation, will find the same subdirectory
-            in the destination directory, making any non-existing subdirectories recursively,
-            then finally copying the file
+        Applies a coalesced batch of events to the destination. Runs of creates/modifies are
+            copied in parallel on the pool, since after coalescing each is for a different
+            file; moves and deletes wait for those to finish and then run one at a time, as
+            they may touch the same files
         Arguments:
-            event (watchdog.events.FileCreatedEvent): the event fired
+            events (List[QueuedEvent]): The events to apply, oldest first
         """
-        try:
-            if event.is_directory:
-                return
+        copies = []
+        for event_type, src_path, dest_path in events:
+            if event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+                copies.append(self._pool.submit(self.__backup_copied, src_path))
+                continue
 
-            if self.ignore_pattern and re.search(self.ignore_pattern, event.src_path):
-                return
+            futures.wait(copies)
+            copies.clear()
 
-            self.__log_event(event)
-            src = Path(event.src_path).absolute()
-            in_dest = self.__in_destination(src)
-            os.makedirs(in_dest.parent.absolute(), exist_ok=True)
-            shutil.copy2(src, self.__in_destination(src))
-        except Exception as exc:
-            self.logger.warn(f"Exception thrown in Handler#on_created:\n\t{exc}")
+            if event_type == EVENT_TYPE_MOVED:
+                self.__backup_moved(src_path, dest_path)
+            elif event_type == EVENT_TYPE_DELETED:
+                self.__backup_deleted(src_path)
 
-    def on_modified(self, event: FileModifiedEvent) -> None:
+        futures.wait(copies)
+
+    @staticmethod
+    def __coalesce(batch: List[QueuedEvent]) -> List[QueuedEvent]:
         """
-        Called upon modification of a file, at which point the backed up file is
-            deleted and then re-copied from the source.
+        Drops events which would only redo work already queued in the same batch. Editors and
+            build tools tend to fire several creates/modifies per save, and since the copy reads
+            whatever is on disk when it runs, only the first one for each path needs to happen
         Arguments:
-            event (watchdog.events.FileModifiedEvent): the event fired
+            batch (List[QueuedEvent]): The queued events, oldest first
+        Returns:
+            (List[QueuedEvent]): The events still worth applying, oldest first
         """
-        try:
-            if event.is_directory:
-                return
+        events: List[Optional[QueuedEvent]] = []
+        pending_copies = {}  # src path -> index in `events` of a queued create/modify
+
+        for event in batch:
+            event_type, src_path, dest_path = event
+            if event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+                if src_path in pending_copies:
+                    continue
+                pending_copies[src_path] = len(events)
+            else:
+                # Once the file is deleted or moved away there's nothing left to copy from
+                #   its old path; moves copy the file into its new place themselves
+                index = pending_copies.pop(src_path, None)
+                if index is not None:
+                    events[index] = None
+                if dest_path:
+                    pending_copies.pop(dest_path, None)
+            events.append(event)
+
+        return [event for event in events if event is not None]
+
+    def __queue_event(self, event: FileSystemEvent) -> None:
+        """
+        Hands an event off to the worker thread to be applied to the destination
+        Arguments:
+            event (watchdog.events.FileSystemEvent): the event fired
+        """
+        self._queue.put((event.event_type, event.src_path, event.dest_path))
 
-            if self.ignore_pattern and re.search(self.ignore_pattern, event.src_path):
+    def __make_dirs(self, path: str) -> None:
+        """
+        Makes the given destination directory and any missing parents, skipping the filesystem
+            entirely if we already know it exists
+        Arguments:
+            path (str): The directory to make
+        """
+        with self._cache_lock:
+            if path in self._known_dirs:
+                self._known_dirs.move_to_end(path)
                 return
 
-            self.__log_event(event)
-
-            src = Path(event.src_path).absolute()
-            in_dest = self.__in_destination(src)
+        os.makedirs(path, exist_ok=True)
 
-            if in_dest.exists():
-                in_dest.unlink()
+        with self._cache_lock:
+            self._known_dirs[path] = None
+            if len(self._known_dirs) > MAX_CACHED_DIRS:
+                self._known_dirs.popitem(last=False)
 
-            # Copy over the new file, making required subdirectories
-            os.makedirs(in_dest.parent.absolute(), exist_ok=True)
-            shutil.copy2(src, in_dest)
-        except Exception as exc:
-            self.logger.warn(f"Exception thrown in Handler#on_modified:\n\t{exc}")
+    def __remake_dirs(self, path: str) -> None:
+        """
+        Makes the given destination directory again after finding it was removed from under
+            us, rather than trusting the cache that says it exists
+        Arguments:
+            path (str): The directory to make
+        """
+        with self._cache_lock:
+            self._known_dirs.pop(path, None)
+        self.__make_dirs(path)
 
-    def on_moved(self, event: FileSystemMovedEvent):
+    def __replace(self, before: str, after: str) -> bool:
         """
-        Called upon renaming / relocation of a file. Upon movement, it entirely deletes the
-            prior location as mapped in the destination directory, then essentially does the same
-            thing as `on_created` for a new directory. Cleans up parent directories from the old
-            mapping to ensure no empty folders are just left behind
+        Moves a backed up file to its new place in the destination, deleting it instead if it
+            can't be moved so that it gets copied there fresh
         Arguments:
-            event (watchdog.events.FileSystemMovedEvent): the event fired
+            before (str): The path of the backed up file
+            after (str): The path to move it to, whose parent directory should already exist
+        Returns:
+            (bool): True if the backup was moved, False if it has to be copied instead
         """
         try:
-            if event.is_directory:
-                return
+            os.replace(before, after)
+            return True
+        except FileNotFoundError:
+            if not os.path.lexists(before):
+                return False  # It was never backed up under its old name
+            # It's the new parent directory that's gone, so make it again and retry
+            self.__remake_dirs(os.path.dirname(after))
+            try:
+                os.replace(before, after)
+                return True
+            except OSError:
+                pass
+        except OSError:
+            pass
 
-            if self.ignore_pattern and re.search(self.ignore_pattern, event.src_path):
-                return
+        try:
+            os.unlink(before)
+        except FileNotFoundError:
+            pass
+        return False
 
-            if self.ignore_pattern and re.search(self.ignore_pattern, event.dest_path):
+    def __copy(self, src_path: str, in_dest: str) -> None:
+        """
+        Copies a source file to its place in the destination, unless its size and modification
+            time show it hasn't changed since the last time it was copied
+        Arguments:
+            src_path (str): The path of the file to copy
+            in_dest (str): The path of the file in the destination directory
+        """
+        src_stat = os.stat(src_path)
+        signature = (src_stat.st_size, src_stat.st_mtime_ns)
+        with self._cache_lock:
+            if self._signatures.get(src_path) == signature:
+                self._signatures.move_to_end(src_path)
                 return
 
-            self.__log_event(event)
+        try:
+            fast_copy(src_path, in_dest, src_stat, self._preserve_xattr)
+        except FileNotFoundError:
+            # The destination directory may have been removed from under us, so make it again
+            #   and give the copy one more try
+            self.__remake_dirs(os.path.dirname(in_dest))
+            fast_copy(src_path, in_dest, src_stat, self._preserve_xattr)
+
+        with self._cache_lock:
+            self._signatures[src_path] = signature
+            self._signatures.move_to_end(src_path)
+            if len(self._signatures) > MAX_CACHED_SIGNATURES:
+                self._signatures.popitem(last=False)
+
+    def __backup_copied(self, src_path: str) -> None:
+        """
+        Backs up a newly created or modified file. Will find the same subdirectory in the
+            destination directory, making any non-existing subdirectories recursively, then
+            copies the file over any existing backup
+        Arguments:
+            src_path (str): The path of the created or modified file
+        """
+        try:
+            in_dest = self.__in_destination(src_path)
+            self.__make_dirs(os.path.dirname(in_dest))
+            self.__copy(src_path, in_dest)
+        except Exception as exc:
+            self.logger.warn(f"Exception thrown in Handler#__backup_copied:\n\t{exc}")
 
-            src = Path(event.src_path).absolute()
-            dest = Path(event.dest_path).absolute()
+    def __backup_moved(self, src_path: str, dest_path: str) -> None:
+        """
+        Backs up the renaming / relocation of a file. The backed up file is renamed to its new
+            location within the destination directory, and then brought up to date the same way
+            as `__backup_copied` in case it changed before it moved. Cleans up parent
+            directories from the old mapping to ensure no empty folders are just left behind
+        Arguments:
+            src_path (str): The path the file was moved from
+            dest_path (str): The path the file was moved to
+        """
+        try:
+            in_dest_before = self.__in_destination(src_path)
+            in_dest = self.__in_destination(dest_path)
 
-            in_dest_before = self.__in_destination(src)
-            in_dest = self.__in_destination(dest)
+            # Move the old backup over, making required subdirectories
+            self.__make_dirs(os.path.dirname(in_dest))
+            signature = self._signatures.pop(src_path, None)
+            if self.__replace(in_dest_before, in_dest) and signature is not None:
+                self._signatures[dest_path] = signature
 
-            # Copy over the new file, making required subdirectories
-            os.makedirs(in_dest.parent.absolute(), exist_ok=True)
+            # Copy over the file if it isn't already up to date
             try:
-                shutil.copy2(dest, in_dest)
+                self.__copy(dest_path, in_dest)
             except FileNotFoundError:
                 pass  # Sometimes files are removed by an external app before we finish processing
 
-            # Delete the old file, try to delete parent folder if it's empty
-            if in_dest_before.exists():
-                in_dest_before.unlink()
-
-            self.__recursively_clean_dirs_upwards(in_dest_before.parent.absolute())
+            # Try to delete the old parent folder if it's empty after this batch
+            self._dirs_to_clean.add(os.path.dirname(in_dest_before))
         except Exception as exc:
-            self.logger.warn(f"Exception thrown in Handler#on_moved:\n\t{exc}")
+            self.logger.warn(f"Exception thrown in Handler#__backup_moved:\n\t{exc}")
 
-    def on_deleted(self, event: FileDeletedEvent) -> None:
+    def __backup_deleted(self, src_path: str) -> None:
         """
-        Called upon deletion of a file, at which point the backed up file is deleted
+        Backs up the deletion of a file, at which point the backed up file is deleted
         Arguments:
-            event (watchdog.events.FileDeletedEvent): the event fired
+            src_path (str): The path of the deleted file
         """
         try:
-            if event.is_directory:
-                return
+            in_dest = self.__in_destination(src_path)
 
-            if self.ignore_pattern and re.search(self.ignore_pattern, event.src_path):
-                return
+            self._signatures.pop(src_path, None)
+            try:
+                os.unlink(in_dest)
+            except FileNotFoundError:
+                pass
 
-            self.__log_event(event)
+            self._dirs_to_clean.add(os.path.dirname(in_dest))
+        except Exception as exc:
+            self.logger.warn(f"Exception thrown in Handler#__backup_deleted:\n\t{exc}")
 
-            in_dest = self.__in_destination(event.src_path)
+    def dispatch(self, event: FileSystemEvent) -> None:
+        """
+        Drops directory events and events for ignored paths before watchdog routes the rest
+            to the `on_*` methods below, so that none of them need to check for themselves
+        Arguments:
+            event (watchdog.events.FileSystemEvent): the event fired
+        """
+        if event.is_directory:
+            return
 
-            if in_dest.exists():
-                in_dest.unlink()
+        if self._ignore_re and self._ignore_re.search(event.src_path):
+            return
 
-            self.__recursively_clean_dirs_upwards(in_dest.parent.absolute())
-        except Exception as exc:
-            self.logger.warn(f"Exception thrown in Handler#on_deleted:\n\t{exc}")
+        if (
+            event.dest_path
+            and self._ignore_re
+            and self._ignore_re.search(event.dest_path)
+        ):
+            return
+
+        super().dispatch(event)
+
+    def on_created(self, event: FileCreatedEvent) -> None:
+        """
+        Called upon creation of a new file, queueing it to be copied to the destination
+        Arguments:
+            event (watchdog.events.FileCreatedEvent): the event fired
+        """
+        self.__log_event(event)
+        self.__queue_event(event)
+
+    def on_modified(self, event: FileModifiedEvent) -> None:
+        """
+        Called upon modification of a file, queueing it to be re-copied to the destination
+        Arguments:
+            event (watchdog.events.FileModifiedEvent): the event fired
+        """
+        self.__log_event(event)
+        self.__queue_event(event)
+
+    def on_moved(self, event: FileSystemMovedEvent) -> None:
+        """
+        Called upon renaming / relocation of a file, queueing the same move in the destination
+        Arguments:
+            event (watchdog.events.FileSystemMovedEvent): the event fired
+        """
+        self.__log_event(event)
+        self.__queue_event(event)
+
+    def on_deleted(self, event: FileDeletedEvent) -> None:
+        """
+        Called upon deletion of a file, queueing the backed up file to be deleted
+        Arguments:
+            event (watchdog.events.FileDeletedEvent): the event fired
+        """
+        self.__log_event(event)
+        self.__queue_event(event)